@@ -1,8 +1,16 @@
 from shapely.geometry import Point
+import numpy as np
 import pandas as pd
+import shapely
 import geopandas as gpd
 import osmnx as ox
 
+# Bewaar Overpass-antwoorden lokaal zodat herhaalde runs niet opnieuw downloaden
+ox.settings.use_cache = True
+ox.settings.cache_folder = ".osm_cache"
+ox.settings.requests_timeout = 300
+ox.settings.overpass_rate_limit = True
+
 # Definieer het administratieve niveau en de plaats
 place_name = "Germany"
 admin_level = "8"
@@ -17,29 +25,36 @@ tags = {
 print("Bezig met downloaden van gemeente-polygonen voor", place_name, "(admin_level=8)...")
 municipalities = ox.features_from_place(place_name, tags)
 
-# Verwijder dubbele entries op basis van naam
-# Kan sws beter
-# duplicates op basis van osm-id vindin? (future)
-municipalities = municipalities.drop_duplicates(subset='name')
+# Kolommen opschonen voor export of inspectie
+# Meteen na het downloaden, zodat alle filters hieronder op een smal frame werken
+columns_to_keep = ['name', 'geometry', 'admin_level']
+columns_to_keep = [col for col in columns_to_keep if col in municipalities.columns]
+municipalities = municipalities[columns_to_keep]
+
+# Zet admin_level eenmalig om naar een integer-kolom
+municipalities = municipalities.assign(
+    admin_level=pd.to_numeric(municipalities['admin_level'], errors='coerce', downcast='integer')
+)
+
+# Verwijder dubbele entries op basis van osm-id
+# (de index van osmnx), net als in de chunk-scripts
+municipalities = municipalities[~municipalities.index.duplicated()]
 
 # Behoud enkel Polygon- en MultiPolygon-geometrieen
-municipalities = municipalities[municipalities.geometry.type.isin(['Polygon', 'MultiPolygon'])] # Voeg 'MultiPolygon' later toe
+# Vergelijk de numerieke GEOS type-ids i.p.v. de typenamen als strings
+type_ids = shapely.get_type_id(municipalities.geometry.values)
+municipalities = municipalities[np.isin(type_ids, [shapely.GeometryType.POLYGON, shapely.GeometryType.MULTIPOLYGON])]
 
 # Haal de grenspolygon van België op
 country_boundary = ox.geocode_to_gdf(place_name)
 
 # Filter alleen de entries die admin_level = 8 hebben
-municipalities = municipalities[municipalities['admin_level'] == '8']
+municipalities = municipalities[municipalities['admin_level'] == int(admin_level)]
 
 
 # Behoud enkel gemeenten die volledig binnen de officiële Belgische grens vallen
 municipalities = municipalities[municipalities.geometry.within(country_boundary.loc[0, 'geometry'])]
 
-# Kolommen opschonen voor export of inspectie
-columns_to_keep = ['name', 'geometry', 'admin_level']
-columns_to_keep = [col for col in columns_to_keep if col in municipalities.columns]
-municipalities = municipalities[columns_to_keep]
-
 # Toon wat info enz
 print(f"{len(municipalities)} gemeente-polygonen overgehouden na filtering.")
 print(municipalities.head())
@@ -1,12 +1,18 @@
 import geopandas as gpd
 import osmnx as ox
 import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import numpy as np
+import shapely
+
+from osm_utils import download_municipalities
+from output_utils import finish_output, write_output_batch
 
 def main():
     """
     Downloads and processes administrative boundaries for a country in chunks
     to conserve memory. It fetches states, then gets the municipalities
-    for each state, processes them, and appends them to a single GeoPackage file.
+    for each state, processes them, and appends them to a single output file.
     """
     # --------------------------------------------------------------------------
     # 1. CONFIGURATION
@@ -24,8 +30,29 @@ def main():
         'admin_level': target_admin_level
     }
 
-    # Define the output file path. GeoPackage is preferred for chunking.
-    output_path = f"{place_name.lower()}_municipalities_admin{target_admin_level}.gpkg"
+    # Define the output format and file path. "GeoParquet" appends every state
+    # chunk as its own row group, which is a plain file write and lets readers
+    # skip row groups by bounding box. "GPKG" writes a GeoPackage layer instead.
+    output_format = "GeoParquet"
+    output_extension = "parquet" if output_format == "GeoParquet" else "gpkg"
+    output_path = f"{place_name.lower()}_municipalities_admin{target_admin_level}.{output_extension}"
+    layer_name = f"{place_name.lower()}_municipalities" # Layer name is required for append mode
+
+    # Processed chunks are buffered in memory and written together once this
+    # many municipalities have accumulated (and once more at the end). Kept
+    # to a few states' worth, so the whole country is never held at once.
+    write_batch_size = 5_000
+
+    # Number of states whose municipalities are downloaded concurrently.
+    # Kept low to stay within the Overpass API rate limits.
+    max_download_workers = 4
+
+    # Cache Overpass responses on disk so re-runs skip the network, and let
+    # osmnx wait for a free Overpass slot before each (concurrent) request.
+    ox.settings.use_cache = True
+    ox.settings.cache_folder = ".osm_cache"
+    ox.settings.requests_timeout = 300
+    ox.settings.overpass_rate_limit = True
     
     # --------------------------------------------------------------------------
     # 2. INITIAL SETUP
@@ -37,8 +64,12 @@ def main():
 
     # Set to keep track of OSM IDs that have already been processed and saved.
     # This prevents duplicates if a municipality crosses a state boundary.
+    # Lookups and updates only touch the ids of the current chunk.
     processed_osm_ids = set()
     total_municipalities_saved = 0
+    buffered_chunks = []
+    buffered_rows = 0
+    parquet_writer = None
 
     # --------------------------------------------------------------------------
     # 3. FETCH STATE POLYGONS (CHUNKS)
@@ -54,69 +85,97 @@ def main():
     # --------------------------------------------------------------------------
     # 4. PROCESS EACH CHUNK (STATE)
     # --------------------------------------------------------------------------
-    for i, state in enumerate(states.itertuples()):
-        state_name = getattr(state, 'name', f'State {i+1}')
-        print(f"\n--- Processing chunk {i+1}/{len(states)}: {state_name} ---")
-
-        try:
+    # The downloads are I/O bound, so several states are fetched concurrently.
+    # Processing and writing stay in the main thread, keeping a single writer
+    # for the GeoPackage.
+    with ThreadPoolExecutor(max_workers=max_download_workers) as executor:
+        futures = {}
+        for i, state in enumerate(states.itertuples()):
+            state_name = getattr(state, 'name', f'State {i+1}')
             # Download all admin_level=8 polygons within the current state's geometry.
             # This is the core of the chunking approach.
-            print(f"  Downloading municipalities for {state_name}...")
-            municipalities_chunk = ox.features_from_polygon(state.geometry, tags)
-
-            # --- Data Cleaning for the Chunk ---
-
-            # 1. Filter out OSM IDs that have already been saved from previous chunks.
-            # This is more reliable than dropping duplicates by name.
-            if not municipalities_chunk.empty:
-                original_count = len(municipalities_chunk)
-                municipalities_chunk = municipalities_chunk[~municipalities_chunk.index.isin(processed_osm_ids)]
-                if len(municipalities_chunk) < original_count:
-                    print(f"  Removed {original_count - len(municipalities_chunk)} duplicate OSM IDs found in previous chunks.")
-
-            if municipalities_chunk.empty:
-                print(f"  No new municipalities to process for {state_name}.")
-                continue
-
-            # 2. Keep only Polygon and MultiPolygon geometries.
-            municipalities_chunk = municipalities_chunk[municipalities_chunk.geometry.type.isin(['Polygon', 'MultiPolygon'])]
-
-            # 3. Clean up columns for export.
-            columns_to_keep = ['name', 'geometry', 'admin_level']
-            columns_in_df = [col for col in columns_to_keep if col in municipalities_chunk.columns]
-            municipalities_chunk = municipalities_chunk[columns_in_df]
+            print(f"Downloading municipalities for {state_name}...")
+            futures[executor.submit(download_municipalities, state.geometry, tags)] = state_name
+
+        for i, future in enumerate(as_completed(futures)):
+            state_name = futures[future]
+            print(f"\n--- Processing chunk {i+1}/{len(states)}: {state_name} ---")
+
+            try:
+                municipalities_chunk = future.result()
+
+                # --- Data Cleaning for the Chunk ---
+
+                # 1. Filter out OSM IDs that have already been saved from previous chunks.
+                # This is more reliable than dropping duplicates by name.
+                if not municipalities_chunk.empty:
+                    original_count = len(municipalities_chunk)
+                    municipalities_chunk = municipalities_chunk[
+                        [osm_id not in processed_osm_ids for osm_id in municipalities_chunk.index]
+                    ]
+                    if len(municipalities_chunk) < original_count:
+                        print(f"  Removed {original_count - len(municipalities_chunk)} duplicate OSM IDs found in previous chunks.")
+
+                if municipalities_chunk.empty:
+                    print(f"  No new municipalities to process for {state_name}.")
+                    continue
+
+                # 2. Keep only Polygon and MultiPolygon geometries.
+                # Comparing the numeric GEOS type ids avoids building a Series of type names.
+                type_ids = shapely.get_type_id(municipalities_chunk.geometry.values)
+                municipalities_chunk = municipalities_chunk[
+                    np.isin(type_ids, [shapely.GeometryType.POLYGON, shapely.GeometryType.MULTIPOLYGON])
+                ]
             
-            if municipalities_chunk.empty:
-                print(f"  No valid municipality polygons left after filtering for {state_name}.")
-                continue
+                if municipalities_chunk.empty:
+                    print(f"  No valid municipality polygons left after filtering for {state_name}.")
+                    continue
 
-            # --- Save the Processed Chunk ---
+                # --- Buffer the Processed Chunk ---
 
-            print(f"  Found {len(municipalities_chunk)} new municipalities. Saving to file...")
-            
-            # For the very first chunk, create the file (mode='w').
-            # For all subsequent chunks, append to the file (mode='a').
-            write_mode = 'a' if total_municipalities_saved > 0 else 'w'
-            
-            municipalities_chunk.to_file(
-                output_path,
-                driver="GPKG",
-                mode=write_mode,
-                layer=f"{place_name.lower()}_municipalities" # Layer name is required for append mode
-            )
+                print(f"  Found {len(municipalities_chunk)} new municipalities. Adding to write buffer...")
+                buffered_chunks.append(municipalities_chunk)
+                buffered_rows += len(municipalities_chunk)
 
-            # Update the set of processed IDs and the total count.
-            processed_osm_ids.update(municipalities_chunk.index)
-            total_municipalities_saved += len(municipalities_chunk)
-            print(f"  Successfully saved. Total municipalities so far: {total_municipalities_saved}")
+                # Update the set of processed IDs right away, so later chunks are
+                # deduplicated against buffered municipalities as well.
+                processed_osm_ids.update(municipalities_chunk.index)
 
-        except Exception as e:
-            print(f"  An error occurred while processing {state_name}: {e}")
-            print("  Skipping this chunk.")
+                if buffered_rows >= write_batch_size:
+                    print(f"  Writing {buffered_rows} buffered municipalities to file...")
+
+                    parquet_writer = write_output_batch(
+                        buffered_chunks, output_format, output_path, layer_name,
+                        append=total_municipalities_saved > 0, parquet_writer=parquet_writer
+                    )
+
+                    total_municipalities_saved += buffered_rows
+                    buffered_chunks, buffered_rows = [], 0
+                    print(f"  Successfully saved. Total municipalities so far: {total_municipalities_saved}")
+
+            except Exception as e:
+                print(f"  An error occurred while processing {state_name}: {e}")
+                print("  Skipping this chunk.")
 
     # --------------------------------------------------------------------------
     # 5. FINALIZATION
     # --------------------------------------------------------------------------
+    if buffered_chunks:
+        print(f"\nWriting remaining {buffered_rows} buffered municipalities to file...")
+        try:
+            parquet_writer = write_output_batch(
+                buffered_chunks, output_format, output_path, layer_name,
+                append=total_municipalities_saved > 0, parquet_writer=parquet_writer
+            )
+            total_municipalities_saved += buffered_rows
+        except Exception as e:
+            print(f"  Could not write the remaining municipalities. Error: {e}")
+
+    finish_output(
+        output_format, output_path, layer_name, parquet_writer,
+        has_data=total_municipalities_saved > 0
+    )
+
     print("\n-----------------------------------------------------")
     print("Processing complete.")
     print(f"Total unique municipalities saved: {total_municipalities_saved}")
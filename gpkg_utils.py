@@ -0,0 +1,305 @@
+import sqlite3
+import struct
+
+import numpy as np
+import pandas as pd
+import pyogrio
+import shapely
+
+# Extension registered by GDAL and the GeoPackage spec for R*Tree spatial indexes.
+RTREE_EXTENSION_NAME = 'gpkg_rtree_index'
+RTREE_EXTENSION_DEFINITION = 'http://www.geopackage.org/spec120/#extension_rtree'
+
+# Single-part geometry types GDAL promotes when writing a layer declared with
+# the multi-part type (e.g. Polygons in a MULTIPOLYGON layer).
+_MULTI_PART_TYPES = {
+    'MULTIPOINT': (shapely.GeometryType.POINT, shapely.multipoints),
+    'MULTILINESTRING': (shapely.GeometryType.LINESTRING, shapely.multilinestrings),
+    'MULTIPOLYGON': (shapely.GeometryType.POLYGON, shapely.multipolygons),
+}
+
+# SQLite page cache (in MB) used while GDAL writes a GeoPackage layer and while
+# add_spatial_index builds its R*Tree.
+SQLITE_CACHE_MB = 200
+
+# Length of a geometry blob header holding an XY envelope. Every envelope
+# starts with minx, maxx, miny, maxy, so this is enough for all of them.
+_BLOB_HEADER_BYTES = 40
+
+# Triggers that keep the R*Tree in sync with the feature table, as GDAL 3.12
+# creates them (GeoPackage 1.4). They call the ST_* functions GDAL registers on
+# its connections, so they only fire when the file is modified through GDAL
+# afterwards. test_gpkg_utils.py checks them against the ones GDAL generates.
+_RTREE_TRIGGERS = (
+    """
+CREATE TRIGGER "rtree_{t}_{c}_insert" AFTER INSERT ON "{t}"
+WHEN (new."{c}" NOT NULL AND NOT ST_IsEmpty(NEW."{c}"))
+BEGIN
+  INSERT OR REPLACE INTO "rtree_{t}_{c}" VALUES (
+    NEW."{i}",
+    ST_MinX(NEW."{c}"), ST_MaxX(NEW."{c}"),
+    ST_MinY(NEW."{c}"), ST_MaxY(NEW."{c}")
+  );
+END;
+""",
+    """
+CREATE TRIGGER "rtree_{t}_{c}_update6" AFTER UPDATE OF "{c}" ON "{t}"
+WHEN OLD."{i}" = NEW."{i}" AND
+     (NEW."{c}" NOTNULL AND NOT ST_IsEmpty(NEW."{c}")) AND
+     (OLD."{c}" NOTNULL AND NOT ST_IsEmpty(OLD."{c}"))
+BEGIN
+  UPDATE "rtree_{t}_{c}" SET
+    minx = ST_MinX(NEW."{c}"), maxx = ST_MaxX(NEW."{c}"),
+    miny = ST_MinY(NEW."{c}"), maxy = ST_MaxY(NEW."{c}")
+  WHERE id = NEW."{i}";
+END;
+""",
+    """
+CREATE TRIGGER "rtree_{t}_{c}_update7" AFTER UPDATE OF "{c}" ON "{t}"
+WHEN OLD."{i}" = NEW."{i}" AND
+     (NEW."{c}" NOTNULL AND NOT ST_IsEmpty(NEW."{c}")) AND
+     (OLD."{c}" ISNULL OR ST_IsEmpty(OLD."{c}"))
+BEGIN
+  INSERT INTO "rtree_{t}_{c}" VALUES (
+    NEW."{i}",
+    ST_MinX(NEW."{c}"), ST_MaxX(NEW."{c}"),
+    ST_MinY(NEW."{c}"), ST_MaxY(NEW."{c}")
+  );
+END;
+""",
+    """
+CREATE TRIGGER "rtree_{t}_{c}_update2" AFTER UPDATE OF "{c}" ON "{t}"
+WHEN OLD."{i}" = NEW."{i}" AND
+     (NEW."{c}" ISNULL OR ST_IsEmpty(NEW."{c}"))
+BEGIN
+  DELETE FROM "rtree_{t}_{c}" WHERE id = OLD."{i}";
+END;
+""",
+    """
+CREATE TRIGGER "rtree_{t}_{c}_update5" AFTER UPDATE ON "{t}"
+WHEN OLD."{i}" != NEW."{i}" AND
+     (NEW."{c}" NOTNULL AND NOT ST_IsEmpty(NEW."{c}"))
+BEGIN
+  DELETE FROM "rtree_{t}_{c}" WHERE id = OLD."{i}";
+  INSERT OR REPLACE INTO "rtree_{t}_{c}" VALUES (
+    NEW."{i}",
+    ST_MinX(NEW."{c}"), ST_MaxX(NEW."{c}"),
+    ST_MinY(NEW."{c}"), ST_MaxY(NEW."{c}")
+  );
+END;
+""",
+    """
+CREATE TRIGGER "rtree_{t}_{c}_update4" AFTER UPDATE ON "{t}"
+WHEN OLD."{i}" != NEW."{i}" AND
+     (NEW."{c}" ISNULL OR ST_IsEmpty(NEW."{c}"))
+BEGIN
+  DELETE FROM "rtree_{t}_{c}" WHERE id IN (OLD."{i}", NEW."{i}");
+END;
+""",
+    """
+CREATE TRIGGER "rtree_{t}_{c}_delete" AFTER DELETE ON "{t}"
+WHEN old."{c}" NOT NULL
+BEGIN
+  DELETE FROM "rtree_{t}_{c}" WHERE id = OLD."{i}";
+END;
+""",
+)
+
+
+def _blob_envelope(header, read_blob):
+    """
+    Returns (minx, maxx, miny, maxy) for a GeoPackage geometry blob, or None
+    if the geometry is empty. Only the blob header is needed when it stores
+    an envelope; otherwise read_blob() is called for the full blob and the
+    WKB payload is parsed.
+    """
+    flags = header[3]
+    if flags & 0b10000:
+        return None
+    envelope_indicator = (flags >> 1) & 0b111
+    if envelope_indicator:
+        byte_order = '<' if flags & 1 else '>'
+        return struct.unpack_from(f'{byte_order}4d', header, 8)
+    minx, miny, maxx, maxy = shapely.from_wkb(read_blob()[8:]).bounds
+    return minx, maxx, miny, maxy
+
+
+def _promote_to_multi(geoms, geometry_type_name):
+    """
+    Converts single-part geometries to the multi-part type of the layer, as
+    GDAL does on write, so every row matches the declared geometry type.
+    Geometries of other types are returned unchanged.
+    """
+    if geometry_type_name not in _MULTI_PART_TYPES:
+        return geoms
+    single_type, make_multi = _MULTI_PART_TYPES[geometry_type_name]
+    geoms = np.array(geoms, dtype=object)
+    single = shapely.get_type_id(geoms) == single_type
+    empty = single & shapely.is_empty(geoms)
+    parts = single & ~empty
+    geoms[parts] = make_multi(geoms[parts][:, np.newaxis])
+    geoms[empty] = shapely.from_wkt(f'{geometry_type_name} EMPTY')
+    return geoms
+
+
+def _gpkg_blobs(geoms, srs_id):
+    """
+    Encodes geometries as GeoPackage geometry blobs: the standard header with
+    the srs_id and an XY envelope, followed by little-endian 2D WKB. Missing
+    geometries become None; empty ones get the empty flag and no envelope.
+    """
+    wkbs = shapely.to_wkb(geoms, byte_order=1, output_dimension=2)
+    bounds = shapely.bounds(geoms)
+    empty = shapely.is_empty(geoms)
+    blobs = []
+    for wkb, (minx, miny, maxx, maxy), is_empty in zip(wkbs, bounds, empty):
+        if wkb is None:
+            blobs.append(None)
+        elif is_empty:
+            blobs.append(struct.pack('<2sBBi', b'GP', 0, 0b10001, srs_id) + wkb)
+        else:
+            header = struct.pack('<2sBBi4d', b'GP', 0, 0b00011, srs_id, minx, maxx, miny, maxy)
+            blobs.append(header + wkb)
+    return blobs
+
+
+def write_chunks(chunks, gpkg_path, layer_name, mode):
+    """
+    Writes a list of GeoDataFrame chunks to a GeoPackage layer as one batch.
+    With mode='w' the layer is created by a single GDAL to_file call (pyogrio
+    engine, without spatial index). With mode='a' the chunks are appended to
+    that existing layer by append_chunks, which inserts them directly through
+    SQLite in one transaction and does not call to_file at all. In both cases
+    the spatial index is left to add_spatial_index.
+    """
+    if mode == 'a':
+        append_chunks(chunks, gpkg_path, layer_name)
+        return
+
+    # OGR_SQLITE_CACHE is a GDAL config option, so it only affects the to_file
+    # write below; it is restored afterwards.
+    previous_cache = pyogrio.get_gdal_config_option('OGR_SQLITE_CACHE')
+    pyogrio.set_gdal_config_options({'OGR_SQLITE_CACHE': SQLITE_CACHE_MB})
+    try:
+        pd.concat(chunks).to_file(
+            gpkg_path,
+            driver="GPKG",
+            mode=mode,
+            layer=layer_name,
+            engine="pyogrio",
+            SPATIAL_INDEX="NO"
+        )
+    finally:
+        pyogrio.set_gdal_config_options({'OGR_SQLITE_CACHE': previous_cache})
+
+
+def append_chunks(chunks, gpkg_path, layer_name):
+    """
+    Appends a list of GeoDataFrame chunks to an existing GeoPackage layer with
+    plain SQLite inserts in a single transaction, skipping GDAL's dataset open
+    and schema handling on every append. The layer must have been created by
+    write_chunks and must not have a spatial index yet, as the index triggers
+    rely on functions only GDAL provides.
+    """
+    municipalities = pd.concat(chunks)
+    con = sqlite3.connect(gpkg_path)
+    try:
+        geom_column, geometry_type_name, srs_id = con.execute(
+            'SELECT column_name, geometry_type_name, srs_id FROM gpkg_geometry_columns WHERE table_name = ?',
+            (layer_name,)
+        ).fetchone()
+        table_columns = {row[1] for row in con.execute(f'PRAGMA table_info("{layer_name}")')}
+
+        # to_file writes a named index (osmnx uses element/id) as regular columns.
+        geometry = _promote_to_multi(municipalities.geometry.values, geometry_type_name.upper())
+        if any(name in table_columns for name in municipalities.index.names):
+            municipalities = municipalities.reset_index()
+        attribute_columns = [col for col in municipalities.columns if col != municipalities.geometry.name]
+
+        # Unlike GDAL, plain inserts cannot add columns the first batch did not create.
+        missing_columns = [col for col in attribute_columns if col not in table_columns]
+        if missing_columns:
+            raise ValueError(
+                f"Columns {missing_columns} do not exist in GeoPackage layer '{layer_name}'"
+            )
+
+        rows = zip(
+            _gpkg_blobs(geometry, srs_id),
+            # sqlite3 cannot bind pd.NA (nullable dtypes), so missing values become None.
+            *(municipalities[col].astype(object).where(municipalities[col].notna(), None).tolist()
+              for col in attribute_columns)
+        )
+        column_list = ', '.join(f'"{col}"' for col in [geom_column, *attribute_columns])
+        placeholders = ', '.join('?' * (len(attribute_columns) + 1))
+
+        with con:
+            con.executemany(f'INSERT INTO "{layer_name}" ({column_list}) VALUES ({placeholders})', rows)
+
+            # GDAL only updates the layer extent when it writes the layer itself.
+            minx, miny, maxx, maxy = shapely.total_bounds(geometry)
+            if not np.isnan(minx):
+                con.execute(
+                    'UPDATE gpkg_contents SET '
+                    'min_x = MIN(COALESCE(min_x, :minx), :minx), min_y = MIN(COALESCE(min_y, :miny), :miny), '
+                    'max_x = MAX(COALESCE(max_x, :maxx), :maxx), max_y = MAX(COALESCE(max_y, :maxy), :maxy), '
+                    "last_change = strftime('%Y-%m-%dT%H:%M:%fZ', 'now') "
+                    'WHERE table_name = :layer',
+                    {'minx': minx, 'miny': miny, 'maxx': maxx, 'maxy': maxy, 'layer': layer_name}
+                )
+    finally:
+        con.close()
+
+
+def add_spatial_index(gpkg_path, layer_name):
+    """
+    Builds the R*Tree spatial index of a GeoPackage layer in a single pass.
+    Intended for layers written with SPATIAL_INDEX=NO, so the index is
+    created once at the end instead of being maintained on every append.
+    Only the blob headers are read, one row at a time.
+    """
+    con = sqlite3.connect(gpkg_path)
+    try:
+        # A negative cache_size is in KiB.
+        con.execute(f'PRAGMA cache_size = {-SQLITE_CACHE_MB * 1024}')
+        geom_column, = con.execute(
+            'SELECT column_name FROM gpkg_geometry_columns WHERE table_name = ?',
+            (layer_name,)
+        ).fetchone()
+        id_column = next(
+            row[1] for row in con.execute(f'PRAGMA table_info("{layer_name}")') if row[5]
+        )
+        rtree = f'rtree_{layer_name}_{geom_column}'
+
+        with con:
+            con.execute(
+                'CREATE TABLE IF NOT EXISTS gpkg_extensions ('
+                'table_name TEXT, column_name TEXT, extension_name TEXT NOT NULL, '
+                'definition TEXT NOT NULL, scope TEXT NOT NULL, '
+                'CONSTRAINT ge_tce UNIQUE (table_name, column_name, extension_name))'
+            )
+            con.execute(
+                'INSERT OR IGNORE INTO gpkg_extensions VALUES (?, ?, ?, ?, ?)',
+                (layer_name, geom_column, RTREE_EXTENSION_NAME, RTREE_EXTENSION_DEFINITION, 'write-only')
+            )
+            con.execute(f'CREATE VIRTUAL TABLE "{rtree}" USING rtree(id, minx, maxx, miny, maxy)')
+
+            def read_blob(fid):
+                return con.execute(
+                    f'SELECT "{geom_column}" FROM "{layer_name}" WHERE "{id_column}" = ?', (fid,)
+                ).fetchone()[0]
+
+            headers = con.execute(
+                f'SELECT "{id_column}", substr("{geom_column}", 1, {_BLOB_HEADER_BYTES}) '
+                f'FROM "{layer_name}" WHERE "{geom_column}" IS NOT NULL'
+            )
+            entries = (
+                (fid, *envelope)
+                for fid, header in headers
+                if (envelope := _blob_envelope(header, lambda: read_blob(fid))) is not None
+            )
+            con.executemany(f'INSERT INTO "{rtree}" VALUES (?, ?, ?, ?, ?)', entries)
+
+            for trigger in _RTREE_TRIGGERS:
+                con.execute(trigger.format(t=layer_name, c=geom_column, i=id_column))
+    finally:
+        con.close()
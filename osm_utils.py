@@ -0,0 +1,101 @@
+import numpy as np
+import osmnx as ox
+import pandas as pd
+import shapely
+
+# numba is optional: without it points_in_rings runs as plain Python.
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+    prange = range
+
+# Columns kept for export. osmnx returns a column for every OSM tag, so the
+# rest is dropped right after downloading to keep all later filtering cheap.
+COLUMNS_TO_KEEP = ['name', 'geometry', 'admin_level']
+
+
+def download_municipalities(state_geom, tags):
+    """
+    Downloads the features matching the tags for a single state. Overpass is
+    queried with the state's bounding box, which is far cheaper server-side
+    than clipping against the detailed state polygon. Features that do not
+    intersect the state itself are then dropped locally.
+    """
+    features = ox.features_from_bbox(state_geom.bounds, tags)
+    # Every chunk gets exactly these columns (missing ones are filled with
+    # nulls), so all chunks share one schema when they are written out.
+    features = features.reindex(columns=COLUMNS_TO_KEEP)
+    # Parse admin_level once so it is compared and stored as an integer. The
+    # dtype is fixed (values that are not integers become null), so it does
+    # not depend on which chunk happens to be written first.
+    admin_level = pd.to_numeric(features['admin_level'], errors='coerce')
+    features = features.assign(
+        name=features['name'].astype('string'),
+        admin_level=admin_level.where(admin_level % 1 == 0).astype('Int16')
+    )
+    shapely.prepare(state_geom)
+    return features[shapely.intersects(state_geom, features.geometry.values)]
+
+
+def duplicate_geometries(geoms, saved_geoms, tolerance):
+    """
+    Flags the geometries that repeat an already saved geometry, or an earlier
+    geometry of the same array, within the given tolerance. Returns a boolean
+    mask over geoms, so of two matching geometries only the later one is
+    flagged. Candidates come from one STRtree query; only pairs with nearly
+    identical bounds are compared by Hausdorff distance.
+    """
+    geoms = np.asarray(geoms)
+    offset = len(saved_geoms)
+    all_geoms = np.concatenate([saved_geoms, geoms])
+    input_idx, tree_idx = shapely.STRtree(all_geoms).query(geoms)
+
+    # Only compare against saved geometries and earlier geometries of this array.
+    earlier = tree_idx < offset + input_idx
+    input_idx, tree_idx = input_idx[earlier], tree_idx[earlier]
+
+    bounds_diff = shapely.bounds(geoms[input_idx]) - shapely.bounds(all_geoms[tree_idx])
+    close = np.all(np.abs(bounds_diff) <= tolerance, axis=1)
+    input_idx, tree_idx = input_idx[close], tree_idx[close]
+
+    same = shapely.hausdorff_distance(geoms[input_idx], all_geoms[tree_idx]) <= tolerance
+    duplicates = np.zeros(len(geoms), dtype=bool)
+    duplicates[input_idx[same]] = True
+    return duplicates
+
+
+def polygon_rings(geom):
+    """
+    Flattens the exterior and interior rings of a (Multi)Polygon into x and y
+    coordinate arrays, plus an offsets array marking where each ring starts.
+    """
+    rings = shapely.get_rings(shapely.get_parts(geom))
+    coords, ring_index = shapely.get_coordinates(rings, return_index=True)
+    ring_offsets = np.searchsorted(ring_index, np.arange(len(rings) + 1))
+    return np.ascontiguousarray(coords[:, 0]), np.ascontiguousarray(coords[:, 1]), ring_offsets
+
+
+def points_in_rings(xs, ys, ring_x, ring_y, ring_offsets):
+    """
+    Even-odd ray casting of every point against all rings at once, so holes
+    and multiple parts are handled without distinguishing ring types.
+    Compiled with numba (in parallel over the points) when it is available.
+    """
+    inside = np.zeros(len(xs), dtype=np.bool_)
+    for p in prange(len(xs)):
+        x, y = xs[p], ys[p]
+        crossings = 0
+        for r in range(len(ring_offsets) - 1):
+            j = ring_offsets[r + 1] - 1
+            for i in range(ring_offsets[r], ring_offsets[r + 1]):
+                if (ring_y[i] > y) != (ring_y[j] > y) and \
+                        x < (ring_x[j] - ring_x[i]) * (y - ring_y[i]) / (ring_y[j] - ring_y[i]) + ring_x[i]:
+                    crossings += 1
+                j = i
+        inside[p] = crossings % 2 == 1
+    return inside
+
+
+if njit is not None:
+    points_in_rings = njit(parallel=True, cache=True)(points_in_rings)
@@ -0,0 +1,30 @@
+from gpkg_utils import add_spatial_index, write_chunks
+from parquet_utils import write_parquet_chunks
+
+
+def write_output_batch(chunks, output_format, output_path, layer_name, append, parquet_writer=None):
+    """
+    Writes a batch of GeoDataFrame chunks in the configured output format.
+    "GeoParquet" appends every chunk as a row group through parquet_writer.
+    "GPKG" creates the layer on the first batch and appends to it afterwards,
+    since later batches are inserted directly into the existing SQLite table.
+    Returns the ParquetWriter, which is created on the first GeoParquet batch.
+    """
+    if output_format == "GeoParquet":
+        return write_parquet_chunks(chunks, output_path, parquet_writer)
+    write_chunks(chunks, output_path, layer_name, 'a' if append else 'w')
+    return parquet_writer
+
+
+def finish_output(output_format, output_path, layer_name, parquet_writer=None, has_data=True):
+    """
+    Completes the output file once all batches are written: closes the
+    GeoParquet writer, or builds the GeoPackage spatial index in one pass.
+    Nothing is done for a GeoPackage the scripts never wrote to (has_data).
+    """
+    if output_format == "GeoParquet":
+        if parquet_writer is not None:
+            parquet_writer.close()
+    elif has_data:
+        print("\nBuilding spatial index...")
+        add_spatial_index(output_path, layer_name)
@@ -0,0 +1,75 @@
+import json
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import shapely
+
+# Name of the bounding-box covering column (GeoParquet 1.1). Its per-row-group
+# statistics let readers skip whole row groups when filtering by bbox.
+BBOX_COLUMN = 'bbox'
+
+
+def _geo_metadata(gdf):
+    """
+    Returns the GeoParquet 'geo' file metadata for a GeoDataFrame with a
+    WKB-encoded geometry column and a bbox covering column.
+    """
+    geometry_name = gdf.geometry.name
+    column = {
+        'encoding': 'WKB',
+        'geometry_types': [],
+        'covering': {
+            'bbox': {
+                'xmin': [BBOX_COLUMN, 'xmin'],
+                'ymin': [BBOX_COLUMN, 'ymin'],
+                'xmax': [BBOX_COLUMN, 'xmax'],
+                'ymax': [BBOX_COLUMN, 'ymax'],
+            }
+        },
+    }
+    if gdf.crs is not None:
+        column['crs'] = gdf.crs.to_json_dict()
+    return {'version': '1.1.0', 'primary_column': geometry_name, 'columns': {geometry_name: column}}
+
+
+def _to_arrow_table(gdf):
+    """
+    Converts a GeoDataFrame to an Arrow table with the geometry as WKB plus
+    the bbox covering column. Like GeoDataFrame.to_parquet, a non-default
+    index (osmnx uses element/id) is stored as regular columns.
+    """
+    geometry_name = gdf.geometry.name
+    geometry = gdf.geometry.values
+    table = pa.Table.from_pandas(gdf.drop(columns=geometry_name), preserve_index=None)
+
+    bounds = shapely.bounds(geometry)
+    bbox = pa.StructArray.from_arrays(
+        [pa.array(bounds[:, i], type=pa.float64()) for i in range(4)],
+        names=['xmin', 'ymin', 'xmax', 'ymax'],
+    )
+    table = table.append_column(geometry_name, pa.array(shapely.to_wkb(geometry), type=pa.binary()))
+    table = table.append_column(BBOX_COLUMN, bbox)
+
+    metadata = dict(table.schema.metadata or {})
+    metadata[b'geo'] = json.dumps(_geo_metadata(gdf)).encode()
+    return table.replace_schema_metadata(metadata)
+
+
+def write_parquet_chunks(chunks, parquet_path, writer=None):
+    """
+    Writes a list of GeoDataFrame chunks to a GeoParquet file, one row group
+    per chunk. Appending a row group is a plain file write, with no index or
+    transaction to maintain. The ParquetWriter is created on the first call
+    and returned so later batches can be appended to the same file; close it
+    once all chunks are written.
+    """
+    for chunk in chunks:
+        table = _to_arrow_table(chunk)
+        if writer is None:
+            writer = pq.ParquetWriter(parquet_path, table.schema)
+        else:
+            # Column dtypes can differ slightly between chunks (e.g. admin_level
+            # parsed as int8 in one and float in another).
+            table = table.cast(writer.schema)
+        writer.write_table(table, row_group_size=len(table))
+    return writer
@@ -1,12 +1,20 @@
 import geopandas as gpd
 import osmnx as ox
 import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import numpy as np
+import shapely
+
+from osm_utils import download_municipalities, duplicate_geometries, points_in_rings, polygon_rings
+from output_utils import finish_output, write_output_batch
 
 def main():
     """
     Downloads and processes administrative boundaries for a country in chunks
     to conserve memory. It fetches states, gets municipalities for each,
-    applies strict filtering, and appends them to a single GeoPackage file.
+    applies strict filtering, and appends them to a single output file.
+    Only the geometries of already saved municipalities are kept for the
+    whole run, to detect duplicates across states.
     """
     # --------------------------------------------------------------------------
     # 1. CONFIGURATION
@@ -20,7 +28,38 @@ def main():
         'admin_level': target_admin_level
     }
 
-    output_path = f"{place_name.lower()}_municipalities_admin{target_admin_level}.gpkg"
+    # "GeoParquet" writes one row group per state chunk; "GPKG" a GeoPackage layer.
+    output_format = "GeoParquet"
+    output_extension = "parquet" if output_format == "GeoParquet" else "gpkg"
+    output_path = f"{place_name.lower()}_municipalities_admin{target_admin_level}.{output_extension}"
+    layer_name = f"{place_name.lower()}_municipalities"
+
+    # Processed chunks are buffered and written together in batches of this size,
+    # a few states' worth, so the whole country is never held at once.
+    write_batch_size = 5_000
+
+    # Tolerance (in degrees, roughly 100 m) used to simplify the country boundary
+    # for the coarse pre-filter.
+    boundary_simplify_tolerance = 0.001
+
+    # Use the numba ray-casting kernel instead of shapely's prepared 'contains'
+    # for the representative points of border features. The kernel tests every
+    # point against every boundary vertex, so on a detailed boundary it is
+    # several times slower than the prepared geometry; it needs numba.
+    use_numba_point_in_polygon = False
+
+    # Maximum distance (in degrees, roughly 10 m) between two outlines for them
+    # to count as the same municipality mapped under different OSM ids.
+    duplicate_geometry_tolerance = 0.0001
+
+    # Number of concurrent state downloads, kept low for the Overpass rate limits.
+    max_download_workers = 4
+
+    # Cache Overpass responses on disk and throttle requests to the rate limit.
+    ox.settings.use_cache = True
+    ox.settings.cache_folder = ".osm_cache"
+    ox.settings.requests_timeout = 300
+    ox.settings.overpass_rate_limit = True
     
     # --------------------------------------------------------------------------
     # 2. INITIAL SETUP
@@ -30,7 +69,12 @@ def main():
         print(f"Removed existing file: {output_path}")
 
     processed_osm_ids = set()
+    # Geometries saved so far, used to drop the same municipality under another id.
+    processed_geoms = np.empty(0, dtype=object)
     total_municipalities_saved = 0
+    buffered_chunks = []
+    buffered_rows = 0
+    parquet_writer = None
 
     # --------------------------------------------------------------------------
     # 3. FETCH BOUNDARIES FOR FILTERING
@@ -40,6 +84,22 @@ def main():
         # Get the main polygon for the entire country
         country_boundary = ox.geocode_to_gdf(place_name)
         country_geom = country_boundary.geometry.iloc[0]
+        # Prepare the geometry once so every containment test below reuses
+        # the same cached spatial index of the (very detailed) boundary.
+        shapely.prepare(country_geom)
+
+        # Coarse outlines of the boundary for cheap pre-filtering. The simplified
+        # outline is grown and shrunk by twice the simplification tolerance, so a
+        # feature inside the inner outline is certainly inside the country and a
+        # feature outside the outer outline certainly is not.
+        simplified_country = country_geom.simplify(boundary_simplify_tolerance, preserve_topology=True)
+        country_outer = simplified_country.buffer(2 * boundary_simplify_tolerance)
+        country_inner = simplified_country.buffer(-2 * boundary_simplify_tolerance)
+        shapely.prepare(country_outer)
+        shapely.prepare(country_inner)
+
+        # Flat coordinate arrays of the boundary for the compiled point-in-polygon test.
+        country_rings = polygon_rings(country_geom) if use_numba_point_in_polygon else None
         print("✔ Main country boundary downloaded.")
     except Exception as e:
         print(f"❌ Could not download country boundary. Cannot proceed. Error: {e}")
@@ -57,78 +117,144 @@ def main():
     # 4. PROCESS EACH CHUNK (STATE)
     # --------------------------------------------------------------------------
     print("\nStep 3: Processing municipalities for each state...")
-    for i, state in enumerate(states.itertuples()):
-        state_name = getattr(state, 'name', f'State {i+1}')
-        print(f"\n--- Processing chunk {i+1}/{len(states)}: {state_name} ---")
-
-        try:
+    # Downloads run concurrently; processing and writing stay in the main thread.
+    with ThreadPoolExecutor(max_workers=max_download_workers) as executor:
+        futures = {}
+        for i, state in enumerate(states.itertuples()):
+            state_name = getattr(state, 'name', f'State {i+1}')
             print(f"  Downloading municipalities for {state_name}...")
-            municipalities_chunk = ox.features_from_polygon(state.geometry, tags)
-
-            if municipalities_chunk.empty:
-                print("  No features returned from OSM for this chunk.")
-                continue
-
-            # --- ⭐️ NEW: Strict Data Cleaning and Filtering ⭐️ ---
-            
-            # 1. Explicitly filter for the correct admin_level.
-            # This is a crucial check as OSM can sometimes return related features with other levels.
-            initial_count = len(municipalities_chunk)
-            municipalities_chunk = municipalities_chunk[
-                municipalities_chunk['admin_level'] == target_admin_level
-            ]
-            print(f"  Filtering by admin_level='{target_admin_level}': {initial_count} -> {len(municipalities_chunk)} features")
-            
-            # 2. Ensure all geometries are completely within the main country boundary.
-            # This removes any neighboring country's data or offshore anomalies.
-            initial_count = len(municipalities_chunk)
-            municipalities_chunk = municipalities_chunk[
-                municipalities_chunk.geometry.within(country_geom)
-            ]
-            print(f"  Filtering by country boundary: {initial_count} -> {len(municipalities_chunk)} features")
-            
-            # 3. Filter out OSM IDs that have already been saved from previous chunks.
-            initial_count = len(municipalities_chunk)
-            municipalities_chunk = municipalities_chunk[~municipalities_chunk.index.isin(processed_osm_ids)]
-            if len(municipalities_chunk) < initial_count:
-                print(f"  Removed {initial_count - len(municipalities_chunk)} duplicate OSM IDs from prior chunks.")
-
-            if municipalities_chunk.empty:
-                print("  No new, valid municipalities to save in this chunk.")
-                continue
-
-            # 4. Keep only valid Polygon/MultiPolygon geometries and clean up columns.
-            municipalities_chunk = municipalities_chunk[municipalities_chunk.geometry.type.isin(['Polygon', 'MultiPolygon'])]
-            columns_to_keep = ['name', 'geometry', 'admin_level']
-            columns_in_df = [col for col in columns_to_keep if col in municipalities_chunk.columns]
-            municipalities_chunk = municipalities_chunk[columns_in_df]
-            
-            if municipalities_chunk.empty:
-                print("  No valid polygons left after final cleaning.")
-                continue
-
-            # --- Save the Processed Chunk ---
-            print(f"  ✅ Found {len(municipalities_chunk)} new municipalities. Saving to file...")
-            write_mode = 'a' if total_municipalities_saved > 0 else 'w'
-            
-            municipalities_chunk.to_file(
-                output_path,
-                driver="GPKG",
-                mode=write_mode,
-                layer=f"{place_name.lower()}_municipalities"
-            )
+            futures[executor.submit(download_municipalities, state.geometry, tags)] = (state, state_name)
 
-            processed_osm_ids.update(municipalities_chunk.index)
-            total_municipalities_saved += len(municipalities_chunk)
-            print(f"  Successfully saved. Total so far: {total_municipalities_saved}")
+        for i, future in enumerate(as_completed(futures)):
+            state, state_name = futures[future]
+            print(f"\n--- Processing chunk {i+1}/{len(states)}: {state_name} ---")
 
-        except Exception as e:
-            print(f"  ❌ An error occurred while processing {state_name}: {e}")
-            print("  Skipping this chunk.")
+            try:
+                municipalities_chunk = future.result()
+
+                if municipalities_chunk.empty:
+                    print("  No features returned from OSM for this chunk.")
+                    continue
+
+                # --- ⭐️ NEW: Strict Data Cleaning and Filtering ⭐️ ---
+                # Every filter below only narrows a single boolean mask; the chunk
+                # (including its geometry column) is indexed once at the end instead
+                # of being copied after each filter.
+                geoms = municipalities_chunk.geometry.values
+
+                # 1. Explicitly filter for the correct admin_level.
+                # This is a crucial check as OSM can sometimes return related features with other levels.
+                # admin_level has already been parsed to an integer column.
+                keep = (municipalities_chunk['admin_level'] == int(target_admin_level)).to_numpy(
+                    dtype=bool, na_value=False
+                )
+                print(f"  Filtering by admin_level='{target_admin_level}': {len(keep)} -> {keep.sum()} features")
+
+                # 2. Keep only valid Polygon/MultiPolygon geometries.
+                type_ids = shapely.get_type_id(geoms)
+                valid_type = np.isin(type_ids, [shapely.GeometryType.POLYGON, shapely.GeometryType.MULTIPOLYGON])
+                print(f"  Filtering by geometry type: {keep.sum()} -> {(keep & valid_type).sum()} features")
+                keep &= valid_type
+
+                if not keep.any():
+                    print("  No valid polygons left after final cleaning.")
+                    continue
+
+                # 3. Filter out OSM IDs that have already been saved from previous chunks.
+                duplicates = keep & np.array(
+                    [osm_id in processed_osm_ids for osm_id in municipalities_chunk.index], dtype=bool
+                )
+                if duplicates.any():
+                    keep &= ~duplicates
+                    print(f"  Removed {duplicates.sum()} duplicate OSM IDs from prior chunks.")
+
+                # The same outline can also be returned under two different OSM ids,
+                # within this chunk or from a prior one. Only the first one is kept.
+                positions = np.flatnonzero(keep)
+                geometric_duplicates = positions[
+                    duplicate_geometries(geoms[positions], processed_geoms, duplicate_geometry_tolerance)
+                ]
+                if len(geometric_duplicates):
+                    keep[geometric_duplicates] = False
+                    print(f"  Removed {len(geometric_duplicates)} duplicate geometries.")
+
+                # 4. Ensure all geometries are completely within the main country boundary.
+                # This removes any neighboring country's data or offshore anomalies.
+                # If the state lies entirely inside the country without touching its
+                # border, every feature fetched for it does too, so the check is only
+                # needed for border states. It runs last, on the features still kept.
+                if shapely.contains_properly(country_geom, state.geometry):
+                    print("  State lies fully inside the country boundary, skipping boundary filter.")
+                else:
+                    # Features are tested against the simplified outlines first; the exact
+                    # 'contains' predicate (the inverse of 'within') against the detailed
+                    # boundary is only evaluated for the few features near the border.
+                    positions = np.flatnonzero(keep)
+                    kept_geoms = geoms[positions]
+                    inside = shapely.contains(country_inner, kept_geoms)
+                    candidates = np.flatnonzero(~inside)
+
+                    # A feature whose representative point lies outside the country cannot
+                    # be within it, so a vectorized point-in-polygon test rejects foreign
+                    # features before any polygon-in-polygon test is run on them. Empty
+                    # geometries have no such point and are never within the country.
+                    candidates = candidates[~shapely.is_empty(kept_geoms[candidates])]
+                    points = shapely.point_on_surface(kept_geoms[candidates])
+                    if country_rings is not None:
+                        xs, ys = shapely.get_coordinates(points).T
+                        candidates = candidates[points_in_rings(xs, ys, *country_rings)]
+                    else:
+                        candidates = candidates[shapely.contains(country_geom, points)]
+                    candidates = candidates[shapely.contains(country_outer, kept_geoms[candidates])]
+                    inside[candidates] = shapely.contains(country_geom, kept_geoms[candidates])
+                    keep[positions] = inside
+                    print(f"  Filtering by country boundary: {len(positions)} -> {inside.sum()} features")
+
+                municipalities_chunk = municipalities_chunk.iloc[np.flatnonzero(keep)]
+                if municipalities_chunk.empty:
+                    print("  No new, valid municipalities to save in this chunk.")
+                    continue
+
+                # --- Buffer the Processed Chunk ---
+                print(f"  ✅ Found {len(municipalities_chunk)} new municipalities. Adding to write buffer...")
+                buffered_chunks.append(municipalities_chunk)
+                buffered_rows += len(municipalities_chunk)
+                processed_osm_ids.update(municipalities_chunk.index)
+                processed_geoms = np.concatenate([processed_geoms, np.asarray(municipalities_chunk.geometry.values)])
+
+                if buffered_rows >= write_batch_size:
+                    print(f"  Writing {buffered_rows} buffered municipalities to file...")
+                    parquet_writer = write_output_batch(
+                        buffered_chunks, output_format, output_path, layer_name,
+                        append=total_municipalities_saved > 0, parquet_writer=parquet_writer
+                    )
+                    total_municipalities_saved += buffered_rows
+                    buffered_chunks, buffered_rows = [], 0
+                    print(f"  Successfully saved. Total so far: {total_municipalities_saved}")
+
+            except Exception as e:
+                print(f"  ❌ An error occurred while processing {state_name}: {e}")
+                print("  Skipping this chunk.")
 
     # --------------------------------------------------------------------------
     # 5. FINALIZATION
     # --------------------------------------------------------------------------
+    if buffered_chunks:
+        print(f"\nWriting remaining {buffered_rows} buffered municipalities to file...")
+        try:
+            parquet_writer = write_output_batch(
+                buffered_chunks, output_format, output_path, layer_name,
+                append=total_municipalities_saved > 0, parquet_writer=parquet_writer
+            )
+            total_municipalities_saved += buffered_rows
+        except Exception as e:
+            print(f"  ❌ Could not write the remaining municipalities. Error: {e}")
+
+    finish_output(
+        output_format, output_path, layer_name, parquet_writer,
+        has_data=total_municipalities_saved > 0
+    )
+
     print("\n-----------------------------------------------------")
     print("🎉 Processing complete.")
     print(f"Total unique municipalities saved: {total_municipalities_saved}")
@@ -0,0 +1,82 @@
+import re
+import sqlite3
+
+import geopandas as gpd
+import pandas as pd
+import pyogrio
+import shapely
+
+from gpkg_utils import add_spatial_index, write_chunks
+
+LAYER = 'municipalities'
+
+
+def _chunk(names, geoms):
+    index = pd.MultiIndex.from_tuples([('relation', i) for i in range(len(names))], names=['element', 'id'])
+    return gpd.GeoDataFrame({'name': names}, geometry=geoms, index=index, crs=4326)
+
+
+def test_write_append_and_index_round_trip(tmp_path):
+    path = tmp_path / 'out.gpkg'
+    first = _chunk(['a', 'b'], [shapely.box(0, 0, 1, 1), shapely.MultiPolygon([shapely.box(2, 0, 3, 1)])])
+    second = _chunk(['c', 'd'], [shapely.box(10, 10, 11, 11), shapely.box(12, 10, 13, 12)])
+
+    write_chunks([first], path, LAYER, 'w')
+    write_chunks([second], path, LAYER, 'a')
+    add_spatial_index(path, LAYER)
+
+    info = pyogrio.read_info(path, layer=LAYER)
+    assert info['geometry_type'] == 'MultiPolygon'
+    assert info['features'] == 4
+    assert tuple(info['total_bounds']) == (0, 0, 13, 12)
+
+    result = gpd.read_file(path, layer=LAYER)
+    assert result['name'].tolist() == ['a', 'b', 'c', 'd']
+    assert set(result.geom_type) == {'MultiPolygon'}
+    assert shapely.equals(result.geometry.values, pd.concat([first, second]).geometry.values).all()
+
+    # The bbox filter is answered through the R*Tree built by add_spatial_index.
+    assert len(_rtree_entries(path)) == 4
+    assert gpd.read_file(path, layer=LAYER, bbox=(9, 9, 11.5, 11.5))['name'].tolist() == ['c']
+
+
+def _rtree_entries(path):
+    con = sqlite3.connect(path)
+    try:
+        return con.execute(f'SELECT * FROM "rtree_{LAYER}_geom" ORDER BY id').fetchall()
+    finally:
+        con.close()
+
+
+def _rtree_triggers(path):
+    con = sqlite3.connect(path)
+    try:
+        rows = con.execute(
+            "SELECT name, sql FROM sqlite_master WHERE type = 'trigger' AND name LIKE 'rtree_%'"
+        ).fetchall()
+    finally:
+        con.close()
+    return {name: re.sub(r'\s+', '', sql) for name, sql in rows}
+
+
+def test_spatial_index_matches_gdal(tmp_path):
+    chunk = _chunk(['a', 'b'], [shapely.box(0, 0, 1, 1), shapely.box(2, 3, 4, 5)])
+    chunk.to_file(tmp_path / 'gdal.gpkg', layer=LAYER, engine='pyogrio')
+    write_chunks([chunk], tmp_path / 'out.gpkg', LAYER, 'w')
+    add_spatial_index(tmp_path / 'out.gpkg', LAYER)
+
+    assert _rtree_triggers(tmp_path / 'out.gpkg') == _rtree_triggers(tmp_path / 'gdal.gpkg')
+    assert _rtree_entries(tmp_path / 'out.gpkg') == _rtree_entries(tmp_path / 'gdal.gpkg')
+
+    # GDAL keeps the index up to date through the triggers on later writes.
+    _chunk(['c'], [shapely.box(6, 6, 7, 8)]).to_file(tmp_path / 'out.gpkg', layer=LAYER, mode='a', engine='pyogrio')
+    assert _rtree_entries(tmp_path / 'out.gpkg')[-1] == (3, 6, 7, 6, 8)
+
+
+def test_spatial_index_without_blob_envelope(tmp_path):
+    # GDAL writes points without an envelope in the blob header.
+    path = tmp_path / 'points.gpkg'
+    write_chunks([_chunk(['a', 'b'], [shapely.Point(1, 2), shapely.Point(3, 4)])], path, LAYER, 'w')
+    add_spatial_index(path, LAYER)
+
+    assert _rtree_entries(path) == [(1, 1, 1, 2, 2), (2, 3, 3, 4, 4)]
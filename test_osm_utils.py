@@ -0,0 +1,85 @@
+import geopandas as gpd
+import numpy as np
+import osmnx as ox
+import pandas as pd
+import shapely
+
+from osm_utils import download_municipalities, duplicate_geometries, points_in_rings, polygon_rings
+
+TOLERANCE = 0.0001
+
+
+NO_SAVED_GEOMS = np.empty(0, dtype=object)
+
+
+def test_same_geometry_different_id_in_one_chunk():
+    geoms = np.array([shapely.box(0, 0, 1, 1), shapely.box(2, 0, 3, 1), shapely.box(0, 0, 1, 1 + TOLERANCE / 2)])
+
+    duplicates = duplicate_geometries(geoms, NO_SAVED_GEOMS, TOLERANCE)
+
+    assert duplicates.tolist() == [False, False, True]
+
+
+def test_same_geometry_as_saved_geometry():
+    saved = np.array([shapely.box(0, 0, 1, 1)])
+    geoms = np.array([shapely.box(0, 0, 1, 1), shapely.box(0, 0, 1, 1.1)])
+
+    duplicates = duplicate_geometries(geoms, saved, TOLERANCE)
+
+    assert duplicates.tolist() == [True, False]
+
+
+def test_same_geometry_as_saved_and_earlier_geometry():
+    # The last square matches both the saved one and the one before it in the
+    # chunk; the middle one only matches the saved square, not the later copy.
+    saved = np.array([shapely.box(0, 0, 1, 1)])
+    geoms = np.array([shapely.box(5, 5, 6, 6), shapely.box(0, 0, 1, 1), shapely.box(0, 0, 1, 1)])
+
+    duplicates = duplicate_geometries(geoms, saved, TOLERANCE)
+
+    assert duplicates.tolist() == [False, True, True]
+
+
+def test_later_copy_does_not_flag_the_first():
+    geoms = np.array([shapely.box(0, 0, 1, 1), shapely.box(0, 0, 1, 1), shapely.box(5, 5, 6, 6)])
+
+    duplicates = duplicate_geometries(geoms, np.array([shapely.box(5, 5, 6, 6)]), TOLERANCE)
+
+    assert duplicates.tolist() == [False, True, True]
+
+
+def test_admin_level_dtype_does_not_depend_on_nulls(monkeypatch):
+    state = shapely.box(0, 0, 10, 10)
+    clean = gpd.GeoDataFrame(
+        {'name': ['A', 'B'], 'admin_level': ['8', '8'], 'population': ['1', '2']},
+        geometry=[shapely.box(1, 1, 2, 2), shapely.box(3, 3, 4, 4)], crs=4326
+    )
+    with_null = gpd.GeoDataFrame(
+        {'name': ['C', 'D', 'E'], 'admin_level': ['8', None, '8;9']},
+        geometry=[shapely.box(1, 1, 2, 2), shapely.box(3, 3, 4, 4), shapely.box(5, 5, 6, 6)], crs=4326
+    )
+
+    monkeypatch.setattr(ox, 'features_from_bbox', lambda bbox, tags: clean)
+    clean_chunk = download_municipalities(state, {})
+    monkeypatch.setattr(ox, 'features_from_bbox', lambda bbox, tags: with_null)
+    null_chunk = download_municipalities(state, {})
+
+    assert list(clean_chunk.columns) == list(null_chunk.columns) == ['name', 'geometry', 'admin_level']
+    assert clean_chunk['admin_level'].dtype == null_chunk['admin_level'].dtype == 'Int16'
+    assert null_chunk['admin_level'].tolist() == [8, pd.NA, pd.NA]
+
+
+def test_points_in_rings_matches_shapely():
+    # Two parts, one of them with a hole, so every ring type is exercised.
+    country = shapely.MultiPolygon([
+        shapely.box(0, 0, 10, 10).difference(shapely.Point(5, 5).buffer(3)),
+        shapely.Point(15, 5).buffer(2),
+    ])
+    rng = np.random.default_rng(0)
+    xs = rng.uniform(-1, 18, 20_000)
+    ys = rng.uniform(-1, 11, 20_000)
+
+    inside = points_in_rings(xs, ys, *polygon_rings(country))
+
+    assert inside.dtype == bool
+    assert (inside == shapely.contains_xy(country, xs, ys)).all()